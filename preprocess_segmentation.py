@@ -0,0 +1,37 @@
+import os
+import argparse
+from tqdm import tqdm
+from src.detector.data_utils import pack_segmentation
+from src.utils.file_utils import listdir_nohidden
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--data_root_dir", type=str, default="data/MOT16")
+args = parser.parse_args()
+
+
+def main():
+    """
+    Convert every seg_ins/<frame>.png into seg_ins_packed/<frame>.npz,
+    which MOT16ObjDetect loads instead of the png masks when it exists.
+    """
+    for split in ["train", "test"]:
+        split_dir = os.path.join(args.data_root_dir, split)
+        for seq_name in listdir_nohidden(split_dir):
+            seg_dir = os.path.join(split_dir, seq_name, "seg_ins")
+            if not os.path.exists(seg_dir):
+                continue
+            packed_dir = os.path.join(split_dir, seq_name, "seg_ins_packed")
+            os.makedirs(packed_dir, exist_ok=True)
+
+            for seg_file in tqdm(
+                list(listdir_nohidden(seg_dir)), desc=f"pack {seq_name}..."
+            ):
+                packed_file = os.path.splitext(seg_file)[0] + ".npz"
+                pack_segmentation(
+                    seg_path=os.path.join(seg_dir, seg_file),
+                    packed_path=os.path.join(packed_dir, packed_file),
+                )
+
+
+if __name__ == "__main__":
+    main()
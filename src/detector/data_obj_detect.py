@@ -1,23 +1,23 @@
 from collections import defaultdict
-import configparser
-import csv
-from email.policy import default
+import hashlib
 import os
 import os.path as osp
-import pickle
-from tqdm import tqdm, trange
-from PIL import Image
 import numpy as np
-import scipy
 import torch
 import torchvision
-import torchvision.transforms.functional as TF
-import pandas as pd
 
-from src.detector.utils import mask_convert
-from src.detector.data_utils import decode_segmentation
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional, tp_and_fp_of_detection falls back to numpy
+    njit = None
+
+from src.detector.data_utils import (
+    load_packed_segmentation,
+    load_segmentation,
+)
 from src.tracker.data_track import split_sequence_names
-from src.utils.file_utils import listdir_nohidden
+from src.utils.file_utils import listdir_nohidden, scandir_nohidden
 from src.tracker.data_track import load_detection_from_txt
 
 
@@ -46,7 +46,14 @@ class MOT16ObjDetect(torch.utils.data.Dataset):
         vis_threshold=0.25,
         segmentation=False,
         only_obj_w_mask=True,
+        cache_dir=None,
     ):
+        """
+        cache_dir
+            - optional directory for a per-sequence memory mapped cache of decoded frames
+            - frames are decoded on first access and read from the cache afterwards
+            - None (default) decodes every frame from its image file
+        """
         self.root = root
         self.split = split
         self.transforms = transforms
@@ -56,6 +63,12 @@ class MOT16ObjDetect(torch.utils.data.Dataset):
         self._classes = ("background", "pedestrian")
         self._img_paths = []
         self._seg_paths = []
+        self._gt_paths = []
+        self._frame_ids = []
+        self._img_seq_names = []
+        self._gt_cache = {}
+        self._cache_dir = cache_dir
+        self._frame_caches = {}
 
         self._train_folders = listdir_nohidden(os.path.join(root, "train"))
         self._test_folders = listdir_nohidden(os.path.join(root, "test"))
@@ -78,41 +91,55 @@ class MOT16ObjDetect(torch.utils.data.Dataset):
                 config_file
             ), "Path does not exist: {}".format(config_file)
 
-            config = configparser.ConfigParser()
-            config.read(config_file)
-            seq_len = int(config["Sequence"]["seqLength"])
-            im_ext = config["Sequence"]["imExt"]
-            im_dir = config["Sequence"]["imDir"]
+            seq_info = parse_seqinfo(config_file)
+            im_dir = seq_info["imDir"]
+            gt_file = os.path.join(path, "gt", "gt.txt")
 
             self._imDir = os.path.join(path, im_dir)
             self._seg_dir = os.path.join(path, "seg_ins")
+            # packed masks written by preprocess_segmentation.py are preferred over the pngs
+            packed_seg_dir = os.path.join(path, "seg_ins_packed")
+            if os.path.exists(packed_seg_dir):
+                # an interrupted preprocessing run would shift masks against frames
+                if os.path.exists(self._seg_dir):
+                    packed_stems = _file_stems(packed_seg_dir)
+                    png_stems = _file_stems(self._seg_dir)
+                    assert (
+                        packed_stems == png_stems
+                    ), "Incomplete packed masks, rerun preprocess_segmentation.py: {}".format(
+                        packed_seg_dir
+                    )
+                self._seg_dir = packed_seg_dir
 
             if os.path.exists(self._seg_dir):
-                for frame_id, seg_file in enumerate(
-                    os.listdir(self._seg_dir), start=1
+                for frame_id, seg_path in enumerate(
+                    scandir_nohidden(self._seg_dir), start=1
                 ):
-                    # for i in range(1, seq_len + 1):
                     if not sparse_version or (
                         sparse_version and frame_id % sparse_frequency == 0
                     ):
-                        # seg_path = os.path.join(self._seg_dir, f"{i:06d}.png")
-                        seg_path = os.path.join(self._seg_dir, seg_file)
                         self._seg_paths.append(seg_path)
 
-            for frame_id, img_file in enumerate(
-                os.listdir(self._imDir), start=1
-            ):
-                # for i in range(1, seq_len + 1):
+            img_paths = scandir_nohidden(self._imDir)
+            if cache_dir is not None:
+                self._create_frame_cache(
+                    seq_name,
+                    shape=(
+                        len(img_paths),
+                        3,
+                        int(seq_info["imHeight"]),
+                        int(seq_info["imWidth"]),
+                    ),
+                )
+
+            for frame_id, img_path in enumerate(img_paths, start=1):
                 if not sparse_version or (
                     sparse_version and frame_id % sparse_frequency == 0
                 ):
-                    # img_path = os.path.join(self._imDir, f"{i:06d}{im_ext}")
-                    img_path = os.path.join(self._imDir, img_file)
-                    assert os.path.exists(
-                        img_path
-                    ), "Path does not exist: {img_path}"
-                    # self._img_paths.append((img_path, im_width, im_height))
                     self._img_paths.append(img_path)
+                    self._gt_paths.append(gt_file)
+                    self._frame_ids.append(frame_id)
+                    self._img_seq_names.append(seq_name)
                     self._convert_frame_to_img_idx[seq_name][
                         frame_id
                     ] = img_index
@@ -122,44 +149,122 @@ class MOT16ObjDetect(torch.utils.data.Dataset):
     def num_classes(self):
         return len(self._classes)
 
-    def _get_annotation(self, idx):
-        """
+    def __getstate__(self):
+        # memory maps are reopened in each DataLoader worker instead of being pickled
+        state = self.__dict__.copy()
+        state["_frame_caches"] = {}
+        return state
+
+    def _frame_cache_files(self, seq_name):
+        # the root hash keeps caches of different dataset copies apart
+        root_id = hashlib.md5(
+            os.path.abspath(self.root).encode("utf-8")
+        ).hexdigest()[:8]
+        return (
+            os.path.join(self._cache_dir, f"{seq_name}_{root_id}_frames.npy"),
+            os.path.join(self._cache_dir, f"{seq_name}_{root_id}_decoded.npy"),
+        )
+
+    def _create_frame_cache(self, seq_name, shape):
+        """Allocate the cache files once in the main process, before any worker reads them.
+
+        An existing cache is only reused if its shape matches the current frames of the sequence.
         """
+        frames_file, decoded_file = self._frame_cache_files(seq_name)
+        if _npy_matches(frames_file, shape, np.uint8) and _npy_matches(
+            decoded_file, shape[:1], np.bool_
+        ):
+            return
+        os.makedirs(self._cache_dir, exist_ok=True)
+        np.lib.format.open_memmap(
+            frames_file, mode="w+", dtype=np.uint8, shape=shape
+        )
+        np.lib.format.open_memmap(
+            decoded_file, mode="w+", dtype=np.bool_, shape=shape[:1]
+        )
+
+    def _load_image(self, idx):
         img_path = self._img_paths[idx]
-        file_index = int(os.path.basename(img_path).split(".")[0])
+        if self._cache_dir is None:
+            return torchvision.io.read_image(
+                img_path, mode=torchvision.io.ImageReadMode.RGB
+            )
 
-        gt_file = os.path.join(
-            os.path.dirname(os.path.dirname(img_path)), "gt", "gt.txt"
-        )
+        seq_name = self._img_seq_names[idx]
+        if seq_name not in self._frame_caches:
+            self._frame_caches[seq_name] = tuple(
+                np.lib.format.open_memmap(f, mode="r+")
+                for f in self._frame_cache_files(seq_name)
+            )
+        frames, decoded = self._frame_caches[seq_name]
 
-        assert os.path.exists(gt_file), "GT file does not exist: {}".format(
-            gt_file
-        )
+        frame_idx = self._frame_ids[idx] - 1
+        if not decoded[frame_idx]:
+            img = torchvision.io.read_image(
+                img_path, mode=torchvision.io.ImageReadMode.RGB
+            )
+            frames[frame_idx] = img.numpy()
+            decoded[frame_idx] = True
+            return img
+        return torch.from_numpy(np.array(frames[frame_idx]))
+
+    def _load_gt(self, gt_file):
+        """Parse gt.txt once per sequence and reuse it for all its frames."""
+        if gt_file not in self._gt_cache:
+            self._gt_cache[gt_file] = load_detection_from_txt(
+                gt_file, vis_threshold=self._vis_threshold, mode="gt"
+            )
+        return self._gt_cache[gt_file]
 
-        gt = load_detection_from_txt(
-            gt_file, vis_threshold=self._vis_threshold, mode="gt"
+    def _get_gt_np(self, idx):
+        """
+        Returns
+        -------
+        ids : [K] object ids
+        boxes : [K, 4] gt boxes (x1, y1, x2, y2)
+        visibilities : [K]
+        """
+        frame_id = self._frame_ids[idx]
+        gt = self._load_gt(self._gt_paths[idx])
+        boxes = gt["boxes"][frame_id]
+        visibilities = gt["visibilities"][frame_id]
+
+        num_objs = len(boxes)
+        ids = np.fromiter(boxes.keys(), dtype=np.int64, count=num_objs)
+        boxes_np = np.empty((num_objs, 4), dtype=np.float32)
+        for i, box in enumerate(boxes.values()):
+            boxes_np[i] = box.numpy()
+        visibilities_np = np.fromiter(
+            visibilities.values(), dtype=np.float32, count=num_objs
         )
-        boxes = gt["boxes"][file_index]
-        visibilities = gt["visibilities"][file_index]
+        return ids, boxes_np, visibilities_np
+
+    def _get_annotation(self, idx):
+        """
+        """
+        ids, boxes, visibilities = self._get_gt_np(idx)
 
         # - ids of objects for which bounding boxes are available
         # - it can be the case that more boxes than masks are available
         # - we need to create padded masks for those masks, so that the index of masks matches the index of boxes
         # - padding will be all zeros and removed later again
         if self._segmentation:
-            masks, keep_ids = load_segmentation(
-                seg_path=self._seg_paths[idx],
-                box_ids=torch.Tensor(boxes.keys()),
-                only_obj_with_mask=True,
-            )
-            boxes = {id: vis for (id, vis) in boxes.items() if id in keep_ids}
-            visibilities = {
-                id: vis for (id, vis) in visibilities.items() if id in keep_ids
-            }
+            seg_path = self._seg_paths[idx]
+            if seg_path.endswith(".npz"):
+                masks, keep_ids = load_packed_segmentation(
+                    packed_path=seg_path, box_ids=ids,
+                )
+            else:
+                masks, keep_ids = load_segmentation(
+                    seg_path=seg_path, box_ids=ids, only_obj_w_mask=True,
+                )
+            keep = np.isin(ids, keep_ids)
+            boxes = boxes[keep]
+            visibilities = visibilities[keep]
 
-        num_objs = len(boxes.keys())
-        boxes = torch.stack(list(boxes.values()), axis=0)
-        visibilities = torch.Tensor(list(visibilities.values()))
+        num_objs = len(boxes)
+        boxes = torch.from_numpy(boxes)
+        visibilities = torch.from_numpy(visibilities)
 
         sample = {
             "boxes": boxes,
@@ -175,10 +280,8 @@ class MOT16ObjDetect(torch.utils.data.Dataset):
 
     def __getitem__(self, idx):
         # load images ad masks
-        img_path = self._img_paths[idx]
-
         # mask_path = os.path.join(self.root, "PedMasks", self.masks[idx])
-        img = Image.open(img_path).convert("RGB")
+        img = self._load_image(idx)
 
         target = self._get_annotation(idx)
 
@@ -221,8 +324,7 @@ class MOT16ObjDetect(torch.utils.data.Dataset):
         for image_id, res in results.items():
             path = self._img_paths[image_id]
             img1, name = osp.split(path)
-            # get image number out of name
-            frame = int(name.split(".")[0])
+            frame = self._frame_ids[image_id]
             # smth like /train/MOT17-09-FRCNN or /train/MOT17-09
             tmp = osp.dirname(img1)
             # get the folder name of the sequence and split it
@@ -235,31 +337,28 @@ class MOT16ObjDetect(torch.utils.data.Dataset):
             if outfile not in files.keys():
                 files[outfile] = []
 
-            for box, score in zip(res["boxes"], res["scores"]):
-                x1 = box[0].item()
-                y1 = box[1].item()
-                x2 = box[2].item()
-                y2 = box[3].item()
-                files[outfile].append(
+            boxes = res["boxes"].detach().cpu().numpy()
+            scores = res["scores"].detach().cpu().numpy()
+            num_dets = len(boxes)
+            files[outfile].append(
+                np.column_stack(
                     [
-                        frame,
-                        -1,
-                        x1,
-                        y1,
-                        x2 - x1,
-                        y2 - y1,
-                        score.item(),
-                        -1,
-                        -1,
-                        -1,
+                        np.full(num_dets, frame),
+                        np.full(num_dets, -1),
+                        boxes[:, 0],
+                        boxes[:, 1],
+                        boxes[:, 2] - boxes[:, 0],
+                        boxes[:, 3] - boxes[:, 1],
+                        scores,
+                        np.full(num_dets, -1),
+                        np.full(num_dets, -1),
+                        np.full(num_dets, -1),
                     ]
                 )
+            )
 
         for k, v in files.items():
-            with open(k, "w") as of:
-                writer = csv.writer(of, delimiter=",")
-                for d in v:
-                    writer.writerow(d)
+            np.savetxt(k, np.concatenate(v, axis=0), fmt="%g", delimiter=",")
 
     def compare_detectors(self, results1, results2, ovthresh=0.5):
         all_sequences_compare_results = defaultdict(dict)
@@ -271,11 +370,11 @@ class MOT16ObjDetect(torch.utils.data.Dataset):
                 zip(seq_results1, seq_results2), start=1
             ):
                 im_index = self._convert_frame_to_img_idx[seq_name][frame_id]
-                annotation = self._get_annotation(im_index)
+                _, gt_boxes, gt_visibilities = self._get_gt_np(im_index)
 
-                visible = annotation["visibilities"] > self._vis_threshold
+                visible = gt_visibilities > self._vis_threshold
                 npos += len(visible)
-                im_gt = annotation["boxes"][visible].cpu().numpy()
+                im_gt = gt_boxes[visible]
                 im_det1 = frame_result1["boxes"].cpu().numpy()
                 im_det2 = frame_result2["boxes"].cpu().numpy()
                 
@@ -310,6 +409,8 @@ class MOT16ObjDetect(torch.utils.data.Dataset):
         """
         results[seq_name] = list(frame["boxes"])
         """
+        import pandas as pd
+
         detector_eval_dict = defaultdict(dict)
 
         for seq_name, seq_results in results.items():
@@ -318,11 +419,11 @@ class MOT16ObjDetect(torch.utils.data.Dataset):
             npos = 0
             for frame_id, frame_result in enumerate(seq_results, start=1):
                 im_index = self._convert_frame_to_img_idx[seq_name][frame_id]
-                annotation = self._get_annotation(im_index)
+                _, gt_boxes, gt_visibilities = self._get_gt_np(im_index)
 
-                visible = annotation["visibilities"] > self._vis_threshold
+                visible = gt_visibilities > self._vis_threshold
                 npos += len(visible)
-                im_gt = annotation["boxes"][visible].cpu().numpy()
+                im_gt = gt_boxes[visible]
                 im_det = frame_result["boxes"].cpu().numpy()
 
                 found, im_tp, im_fp = tp_and_fp_of_detection(
@@ -348,10 +449,10 @@ class MOT16ObjDetect(torch.utils.data.Dataset):
         npos = 0
 
         for im_index in list(results.keys()):
-            annotation = self._get_annotation(im_index)
-            visible = annotation["visibilities"] > self._vis_threshold
+            _, gt_boxes, gt_visibilities = self._get_gt_np(im_index)
+            visible = gt_visibilities > self._vis_threshold
             npos += len(visible)
-            im_gt = annotation["boxes"][visible].cpu().numpy()
+            im_gt = gt_boxes[visible]
             im_det = results[im_index]["boxes"].cpu().numpy()
 
             found, im_tp, im_fp = tp_and_fp_of_detection(
@@ -365,60 +466,148 @@ class MOT16ObjDetect(torch.utils.data.Dataset):
         return detector_eval_dict
 
 
-def tp_and_fp_of_detection(im_gt, im_det, ovthresh=0.5):
-    found = np.zeros(len(im_gt))
-    im_tp = np.zeros(len(im_det))
-    im_fp = np.zeros(len(im_det))
-    for i, d in enumerate(im_det):
-        ovmax = -np.inf
-        if im_gt.size > 0:
-            ixmin = np.maximum(im_gt[:, 0], d[0])
-            iymin = np.maximum(im_gt[:, 1], d[1])
-            ixmax = np.minimum(im_gt[:, 2], d[2])
-            iymax = np.minimum(im_gt[:, 3], d[3])
-            iw = np.maximum(ixmax - ixmin + 1.0, 0.0)
-            ih = np.maximum(iymax - iymin + 1.0, 0.0)
-            inters = iw * ih
+def _npy_matches(npy_file, shape, dtype):
+    """Check the header of an existing .npy file without reading its data."""
+    if not os.path.exists(npy_file):
+        return False
+    try:
+        array = np.load(npy_file, mmap_mode="r")
+    except (ValueError, OSError):
+        return False
+    return array.shape == tuple(shape) and array.dtype == dtype
 
-            uni = (
-                (d[2] - d[0] + 1.0) * (d[3] - d[1] + 1.0)
-                + (im_gt[:, 2] - im_gt[:, 0] + 1.0)
-                * (im_gt[:, 3] - im_gt[:, 1] + 1.0)
-                - inters
-            )
 
-            overlaps = inters / uni
-            ovmax = np.max(overlaps)
-            jmax = np.argmax(overlaps)
+def _file_stems(path):
+    return [
+        osp.splitext(osp.basename(file_path))[0]
+        for file_path in scandir_nohidden(path)
+    ]
 
-        if ovmax > ovthresh:
-            if found[jmax] == 0:
-                im_tp[i] = 1.0
-                found[jmax] = 1.0
-            else:
-                im_fp[i] = 1.0
+
+def parse_seqinfo(config_file):
+    """Read the key=value pairs of a MOT seqinfo.ini, ignoring sections."""
+    seq_info = {}
+    with open(config_file, "r") as f:
+        for line in f:
+            if "=" in line:
+                key, value = line.split("=", 1)
+                seq_info[key.strip()] = value.strip()
+    return seq_info
+
+
+def _tp_and_fp_of_detection_loop(im_gt, im_det, ovthresh, one, zero):
+    """
+    IoU + greedy matching in a single pass without temporary arrays, for numba.
+
+    one, zero and ovthresh have the dtype of the boxes, so the arithmetic
+    stays in that precision, exactly like the numpy version.
+    """
+    found = np.zeros(im_gt.shape[0])
+    im_tp = np.zeros(im_det.shape[0])
+    im_fp = np.zeros(im_det.shape[0])
+    for i in range(im_det.shape[0]):
+        det_area = (im_det[i, 2] - im_det[i, 0] + one) * (
+            im_det[i, 3] - im_det[i, 1] + one
+        )
+        # IoU is never negative
+        ovmax = -one
+        jmax = -1
+        for j in range(im_gt.shape[0]):
+            iw = max(
+                min(im_det[i, 2], im_gt[j, 2])
+                - max(im_det[i, 0], im_gt[j, 0])
+                + one,
+                zero,
+            )
+            ih = max(
+                min(im_det[i, 3], im_gt[j, 3])
+                - max(im_det[i, 1], im_gt[j, 1])
+                + one,
+                zero,
+            )
+            inters = iw * ih
+            gt_area = (im_gt[j, 2] - im_gt[j, 0] + one) * (
+                im_gt[j, 3] - im_gt[j, 1] + one
+            )
+            overlap = inters / (det_area + gt_area - inters)
+            if np.isnan(overlap):
+                # np.argmax returns the first nan, which is never a match
+                ovmax = overlap
+                jmax = j
+                break
+            if overlap > ovmax:
+                ovmax = overlap
+                jmax = j
+
+        if ovmax > ovthresh and found[jmax] == 0:
+            im_tp[i] = 1.0
+            found[jmax] = 1.0
         else:
             im_fp[i] = 1.0
     return found, im_tp, im_fp
 
 
+if njit is not None:
+    # error_model="numpy": degenerate boxes give nan like in numpy instead of raising
+    _tp_and_fp_of_detection_loop = njit(cache=True, error_model="numpy")(
+        _tp_and_fp_of_detection_loop
+    )
+
+
+def tp_and_fp_of_detection(im_gt, im_det, ovthresh=0.5):
+    if njit is not None:
+        # same dtype as the numpy version computes in (float32 for float32 boxes)
+        dtype = np.result_type(im_gt, im_det, 1.0)
+        return _tp_and_fp_of_detection_loop(
+            np.ascontiguousarray(im_gt, dtype=dtype).reshape(-1, 4),
+            np.ascontiguousarray(im_det, dtype=dtype).reshape(-1, 4),
+            dtype.type(ovthresh),
+            dtype.type(1.0),
+            dtype.type(0.0),
+        )
+
+    found = np.zeros(len(im_gt))
+    im_tp = np.zeros(len(im_det))
+    im_fp = np.ones(len(im_det))
+    if im_gt.size == 0 or im_det.size == 0:
+        return found, im_tp, im_fp
+
+    # IoU of every detection [N] with every gt box [M] -> [N, M]
+    ixmin = np.maximum(im_det[:, None, 0], im_gt[None, :, 0])
+    iymin = np.maximum(im_det[:, None, 1], im_gt[None, :, 1])
+    ixmax = np.minimum(im_det[:, None, 2], im_gt[None, :, 2])
+    iymax = np.minimum(im_det[:, None, 3], im_gt[None, :, 3])
+    iw = np.maximum(ixmax - ixmin + 1.0, 0.0)
+    ih = np.maximum(iymax - iymin + 1.0, 0.0)
+    inters = iw * ih
+
+    det_area = (im_det[:, 2] - im_det[:, 0] + 1.0) * (
+        im_det[:, 3] - im_det[:, 1] + 1.0
+    )
+    gt_area = (im_gt[:, 2] - im_gt[:, 0] + 1.0) * (
+        im_gt[:, 3] - im_gt[:, 1] + 1.0
+    )
+    uni = det_area[:, None] + gt_area[None, :] - inters
+
+    overlaps = inters / uni
+    jmax = np.argmax(overlaps, axis=1)
+    ovmax = overlaps[np.arange(len(im_det)), jmax]
+
+    # each gt box can only be matched by the first detection that hits it
+    for i in np.where(ovmax > ovthresh)[0]:
+        if found[jmax[i]] == 0:
+            im_tp[i] = 1.0
+            im_fp[i] = 0.0
+            found[jmax[i]] = 1.0
+    return found, im_tp, im_fp
+
+
 def detection_metrics_from_tp_and_fp(tp, fp, npos):
-    # Flatten out tp and fp into a numpy array
-    i = 0
-    for im in tp:
-        if type(im) != type([]):
-            i += im.shape[0]
-
-    tp_flat = np.zeros(i)
-    fp_flat = np.zeros(i)
-
-    i = 0
-    for tp_im, fp_im in zip(tp, fp):
-        if type(tp_im) != type([]):
-            s = tp_im.shape[0]
-            tp_flat[i : s + i] = tp_im
-            fp_flat[i : s + i] = fp_im
-            i += s
+    # Flatten out tp and fp into a numpy array, skipping images without results
+    tp_flat = [im for im in tp if isinstance(im, np.ndarray)]
+    fp_flat = [im for im in fp if isinstance(im, np.ndarray)]
+    tp_flat = np.concatenate(tp_flat) if tp_flat else np.zeros(0)
+    fp_flat = np.concatenate(fp_flat) if fp_flat else np.zeros(0)
 
     tp = np.cumsum(tp_flat)
     fp = np.cumsum(fp_flat)
@@ -443,9 +632,8 @@ def detection_metrics_from_tp_and_fp(tp, fp, npos):
     mrec = np.concatenate(([0.0], rec, [1.0]))
     mpre = np.concatenate(([0.0], prec, [0.0]))
 
-    # compute the precision envelope
-    for i in range(mpre.size - 1, 0, -1):
-        mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
+    # compute the precision envelope (running max from the right)
+    mpre = np.maximum.accumulate(mpre[::-1])[::-1]
 
     # to calculate area under PR curve, look for points
     # where X axis (recall) changes value
@@ -1,3 +1,4 @@
+import os
 import torch
 import torchvision.transforms.functional as TF
 import numpy as np
@@ -58,9 +59,9 @@ def load_segmentation(seg_path, box_ids=None, only_obj_w_mask=True):
     seg_ids = torch.unique(masks)[1:].tolist()
 
     if not box_ids is None:
-        if not isinstance(box_ids, list):
-            box_ids = box_ids.tolist()
-        keep_ids = list(set(box_ids) & set(seg_ids))
+        # integer ids as ndarray, also accepts lists and tensors
+        box_ids = np.asarray(box_ids, dtype=np.int64)
+        keep_ids = list(set(box_ids.tolist()) & set(seg_ids))
         remove_seg_ids = torch.tensor(list(set(seg_ids) - set(keep_ids)))
         masks[torch.isin(masks, remove_seg_ids)] = 0
     else:
@@ -74,12 +75,62 @@ def load_segmentation(seg_path, box_ids=None, only_obj_w_mask=True):
             len(box_ids), 1, 1
         )
         for binary_mask, seg_id in zip(binary_masks, seg_ids):
-            idx_of_id = torch.where(box_ids == seg_id)[0]
+            idx_of_id = torch.from_numpy(np.where(box_ids == seg_id)[0])
             padded_masks[idx_of_id] = binary_mask
         return_masks = padded_masks
     return return_masks, keep_ids
 
 
+def pack_segmentation(seg_path, packed_path):
+    """
+    Convert an encoded instance segmentation png into packed binary masks
+
+    packed file (.npz)
+        - ids : [M] pedestrian ids, sorted
+        - shape : [2] (H, W)
+        - bits : [M, ceil(H * W / 8)] np.packbits of each flattened binary mask
+    """
+    masks = decode_segmentation(np.array(Image.open(seg_path)))
+    ids = np.unique(masks)
+    ids = ids[ids != 0]
+    binary_masks = masks.reshape(1, -1) == ids[:, np.newaxis]
+    # write to a temporary file first, so an interrupted run leaves no broken file
+    tmp_path = packed_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(
+            f,
+            ids=ids,
+            shape=np.array(masks.shape),
+            bits=np.packbits(binary_masks, axis=1),
+        )
+    os.replace(tmp_path, packed_path)
+
+
+def load_packed_segmentation(packed_path, box_ids=None):
+    """
+    Load masks written by pack_segmentation, only unpacking the ids in box_ids
+
+    Returns
+    -------
+    masks : [K, H, W] int32 binary masks, sorted by id
+    keep_ids : [K] ids of the returned masks
+    """
+    packed = np.load(packed_path)
+    seg_ids = packed["ids"]
+    height, width = packed["shape"]
+
+    if box_ids is None:
+        rows = np.arange(len(seg_ids))
+    else:
+        rows = np.where(np.isin(seg_ids, box_ids))[0]
+
+    masks = np.unpackbits(
+        packed["bits"][rows], axis=1, count=height * width
+    ).reshape(len(rows), height, width)
+    # int32 like the masks of load_segmentation
+    return torch.from_numpy(masks).int(), seg_ids[rows].tolist()
+
+
 def load_detection_from_txt(txt_path, vis_threshold=0.0, mode="gt"):
     """
     modes: "det", "gt", "track"
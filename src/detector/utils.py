@@ -98,13 +98,17 @@ class RandomHorizontalFlip(object):
 
 class ToTensor(object):
     def __call__(self, image, target):
-        image = TF.to_tensor(image)
+        if isinstance(image, torch.Tensor):
+            # uint8 tensor from torchvision.io -> float in [0, 1]
+            image = TF.convert_image_dtype(image, torch.float)
+        else:
+            image = TF.to_tensor(image)
         return image, target
 
 
 def obj_detect_transforms(train):
     transforms = []
-    # converts the image, a PIL image, into a PyTorch Tensor
+    # converts the image, a uint8 tensor or PIL image, into a float PyTorch Tensor
     transforms.append(ToTensor())
     if train:
         # during training, randomly flip the training images
@@ -1,25 +1,96 @@
-import cv2
 import numpy as np
-import torchvision
 import torch
 
 
 def convert_box_to_state(boxes):
-    cx, cy, w, h = torchvision.ops.box_convert(boxes, "xyxy", "cxcywh").T
-    ratios = w / h
-    areas = torchvision.ops.box_area(boxes)
-    states = torch.stack([cx, cy, areas, ratios], dim=1)
-    return states.numpy()
+    """[..., 4] boxes (x1, y1, x2, y2) -> [..., 4] states (cx, cy, area, ratio)"""
+    if isinstance(boxes, torch.Tensor):
+        boxes = boxes.detach().cpu().numpy()
+    x1, y1, x2, y2 = boxes[..., 0], boxes[..., 1], boxes[..., 2], boxes[..., 3]
+    w = x2 - x1
+    h = y2 - y1
+    return np.stack([(x1 + x2) * 0.5, (y1 + y2) * 0.5, w * h, w / h], axis=-1)
 
 
 def convert_state_to_box(states):
-    cx, cy, areas, ratios = states.T
+    """[..., 4] states (cx, cy, area, ratio) -> [..., 4] boxes (x1, y1, x2, y2)"""
+    cx, cy, areas, ratios = (
+        states[..., 0],
+        states[..., 1],
+        states[..., 2],
+        states[..., 3],
+    )
     w = np.sqrt(areas * ratios)
     h = areas / w
-    boxes = np.stack(
-        [cx - w / 2.0, cy - h / 2.0, cx + w / 2.0, cy + h / 2.0], axis=1
+    return np.stack(
+        [cx - w / 2.0, cy - h / 2.0, cx + w / 2.0, cy + h / 2.0], axis=-1
     )
-    return torch.from_numpy(boxes)
+
+
+# SORT state transition / noise matrices, the measurement matrix is [I, 0]
+_SORT_A = np.ascontiguousarray(
+    [
+        [1, 0, 0, 0, 1, 0, 0],
+        [0, 1, 0, 0, 0, 1, 0],
+        [0, 0, 1, 0, 0, 0, 1],
+        [0, 0, 0, 1, 0, 0, 0],
+        [0, 0, 0, 0, 1, 0, 0],
+        [0, 0, 0, 0, 0, 1, 0],
+        [0, 0, 0, 0, 0, 0, 1],
+    ],
+    dtype=np.float32,
+)
+
+_SORT_Q = np.ascontiguousarray(
+    [
+        [1, 0, 0, 0, 0, 0, 0],
+        [0, 1, 0, 0, 0, 0, 0],
+        [0, 0, 1, 0, 0, 0, 0],
+        [0, 0, 0, 1, 0, 0, 0],
+        [0, 0, 0, 0, 0.01, 0, 0],
+        [0, 0, 0, 0, 0, 0.01, 0],
+        [0, 0, 0, 0, 0, 0, 0.01 ** 2],
+    ],
+    dtype=np.float32,
+)
+
+_SORT_R = np.ascontiguousarray(
+    [[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 10, 0], [0, 0, 0, 10],],
+    dtype=np.float32,
+)
+
+# (process_variance, measurement_variance, dt) -> (A, Q, R)
+_KALMAN_MATRICES = {}
+
+
+def _kalman_matrices(process_variance, measurement_variance, dt):
+    key = (process_variance, measurement_variance, dt)
+    if key in _KALMAN_MATRICES:
+        return _KALMAN_MATRICES[key]
+
+    # A
+    A = np.eye(8, dtype=np.float32)
+    A[:4, 4:] = np.eye(4, dtype=np.float32) * dt
+
+    # Q
+    Q = np.zeros((8, 8), dtype=np.float32)
+    q = process_variance * np.array([(dt ** 4) / 4, (dt ** 3) / 2])
+    q_derivative = process_variance * np.array([(dt ** 3) / 2, dt ** 2])
+    Q[0, [0, 4]] = q
+    Q[1, [1, 5]] = q
+    Q[2, [2, 6]] = q
+    Q[3, [3, 7]] = q
+
+    Q[4, [0, 4]] = q_derivative
+    Q[5, [1, 5]] = q_derivative
+    Q[6, [2, 6]] = q_derivative
+    Q[7, [3, 7]] = q_derivative
+
+    # R
+    R = measurement_variance * np.eye(4, dtype=np.float32)
+
+    _KALMAN_MATRICES[key] = (A, Q, R)
+    return _KALMAN_MATRICES[key]
 
 
 class SORTKalmanFilter:
@@ -39,86 +110,98 @@ class SORTKalmanFilter:
     """
 
     def __init__(self):
-        self.initial_state = None
-        self.H = np.array(
-            [
-                [1, 0, 0, 0, 0, 0, 0],
-                [0, 1, 0, 0, 0, 0, 0],
-                [0, 0, 1, 0, 0, 0, 0],
-                [0, 0, 0, 1, 0, 0, 0],
-            ],
-            dtype=np.float32,
-        )
+        self.reset()
 
-        self.A = np.array(
-            [
-                [1, 0, 0, 0, 1, 0, 0],
-                [0, 1, 0, 0, 0, 1, 0],
-                [0, 0, 1, 0, 0, 0, 1],
-                [0, 0, 0, 1, 0, 0, 0],
-                [0, 0, 0, 0, 1, 0, 0],
-                [0, 0, 0, 0, 0, 1, 0],
-                [0, 0, 0, 0, 0, 0, 1],
-            ],
-            dtype=np.float32,
-        )
+    def reset(self):
+        self._filter = BatchedSORTKalmanFilter()
 
-        self.Q = np.array(
-            [
-                [1, 0, 0, 0, 0, 0, 0],
-                [0, 1, 0, 0, 0, 0, 0],
-                [0, 0, 1, 0, 0, 0, 0],
-                [0, 0, 0, 1, 0, 0, 0],
-                [0, 0, 0, 0, 0.01, 0, 0],
-                [0, 0, 0, 0, 0, 0.01, 0],
-                [0, 0, 0, 0, 0, 0, 0.01 ** 2],
-            ],
-            dtype=np.float32,
-        )
+    def predict(self):
+        return self._filter.predict()[0]
 
-        self.P = np.array(
-            [
-                [1, 0, 0, 0, 1, 0, 0],
-                [0, 1, 0, 0, 0, 1, 0],
-                [0, 0, 1, 0, 0, 0, 1],
-                [0, 0, 0, 1, 0, 0, 0],
-                [0, 0, 0, 0, 1000, 0, 0],
-                [0, 0, 0, 0, 0, 1000, 0],
-                [0, 0, 0, 0, 0, 0, 1000],
-            ],
-            dtype=np.float32,
-        )
+    def update(self, box):
+        if len(self._filter) == 0:
+            self._filter.add([0], box)
+        else:
+            self._filter.update([0], box)
 
-        self.R = np.array(
-            [[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 10, 0], [0, 0, 0, 10],],
-            dtype=np.float32,
-        )
+
+class BatchedSORTKalmanFilter:
+    """
+    SORTKalmanFilter for all tracks of a tracker at once.
+
+    The states of all T tracks are stored row wise in contiguous arrays,
+    so one frame step is a single batched predict / correct instead of one filter step per track.
+
+    state
+    -----------------
+    x : [T, 7] state relative to the first box of the track
+    P : [T, 7, 7] error covariance
+    initial_states : [T, 4] state of the first box of the track
+    """
+
+    def __init__(self):
         self.reset()
 
     def reset(self):
-        kalman = cv2.KalmanFilter(7, 4)
-        kalman.transitionMatrix = self.A.copy()
-        kalman.measurementMatrix = self.H.copy()
-        kalman.processNoiseCov = self.Q.copy()
-        kalman.errorCovPre = self.P.copy()
-        # kalman.errorCovPost = self.P.copy()
-        kalman.measurementNoiseCov = self.R.copy()
-        self.kalman = kalman
-        self.initial_state = None
+        self.track_ids = []
+        self._rows = {}
+        self._x = np.zeros((0, 7), dtype=np.float32)
+        self._P = np.zeros((0, 7, 7), dtype=np.float32)
+        self._initial_states = np.zeros((0, 4), dtype=np.float32)
+
+    def __contains__(self, track_id):
+        return track_id in self._rows
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    def add(self, track_ids, boxes):
+        """Start the filters of new tracks from their first boxes [N, 4]"""
+        num_new = len(track_ids)
+        for track_id in track_ids:
+            self._rows[track_id] = len(self.track_ids)
+            self.track_ids.append(track_id)
+        states = convert_box_to_state(boxes).reshape(-1, 4).astype(np.float32)
+        self._initial_states = np.concatenate([self._initial_states, states])
+
+        # same as the measurement free first predict in SORTKalmanFilter.update
+        self._x = np.concatenate([self._x, np.zeros((num_new, 7), np.float32)])
+        self._P = np.concatenate(
+            [self._P, np.broadcast_to(_SORT_Q, (num_new, 7, 7))]
+        )
 
-    def predict(self):
-        relative_pred_state = self.kalman.predict()[:4].squeeze()
-        pred_state = self.initial_state + relative_pred_state
-        pred_box = convert_state_to_box(pred_state[np.newaxis]).squeeze()
-        return pred_box
+    def keep(self, track_ids):
+        """Drop the filters of all tracks that are not in track_ids"""
+        keep = np.isin(np.array(self.track_ids, dtype=np.int64), track_ids)
+        self.track_ids = [i for (i, k) in zip(self.track_ids, keep) if k]
+        self._rows = {
+            track_id: row for (row, track_id) in enumerate(self.track_ids)
+        }
+        self._x = self._x[keep]
+        self._P = self._P[keep]
+        self._initial_states = self._initial_states[keep]
 
-    def update(self, box):
-        state = convert_box_to_state(box.unsqueeze(0)).squeeze()
-        if self.initial_state is None:
-            self.initial_state = state
-            self.kalman.predict()
-        else:
-            self.kalman.correct(state.squeeze() - self.initial_state.squeeze())
+    def predict(self):
+        """Returns the predicted boxes [T, 4] in the order of self.track_ids"""
+        self._x = self._x @ _SORT_A.T
+        self._P = _SORT_A @ self._P @ _SORT_A.T + _SORT_Q
+        pred_states = self._initial_states + self._x[:, :4]
+        return torch.from_numpy(convert_state_to_box(pred_states))
+
+    def update(self, track_ids, boxes):
+        """Correct the filters of track_ids with their new boxes [N, 4]"""
+        if len(track_ids) == 0:
+            return
+        rows = np.array([self._rows[i] for i in track_ids], dtype=np.int64)
+        x = self._x[rows]
+        P = self._P[rows]
+        z = convert_box_to_state(boxes) - self._initial_states[rows]
+
+        # H = [I, 0], so H @ P is P[:, :4] and H @ x is x[:, :4]
+        S = P[:, :4, :4] + _SORT_R
+        K = np.linalg.solve(S, P[:, :4, :]).transpose(0, 2, 1)
+        self._x[rows] = x + (K @ (z - x[:, :4])[..., np.newaxis])[..., 0]
+        self._P[rows] = P - K @ P[:, :4, :]
 
 
 class KalmanFilter:
@@ -165,63 +248,35 @@ class KalmanFilter:
     """
 
     def __init__(self, process_variance=50, measurement_variance=1, dt=1 / 30):
-        kalman = cv2.KalmanFilter(8, 4)
-
-        # H
-        H = np.zeros((4, 8), dtype=np.float32)
-        H[:, :4] = np.diag(np.ones((4), dtype=np.float32))
-        kalman.measurementMatrix = H
-
-        # A
-        A = np.eye(8, dtype=np.float32)
-        A[:4, 4:] = np.eye(4, dtype=np.float32) * dt
-        kalman.transitionMatrix = A
-
-        # Q
-        Q = np.zeros((8, 8), dtype=np.float32)
-        q = process_variance * np.array([(dt ** 4) / 4, (dt ** 3) / 2])
-        q_derivative = process_variance * np.array([(dt ** 3) / 2, dt ** 2])
-        Q[0, [0, 4]] = q
-        Q[1, [1, 5]] = q
-        Q[2, [2, 6]] = q
-        Q[3, [3, 7]] = q
-
-        Q[4, [0, 4]] = q_derivative
-        Q[5, [1, 5]] = q_derivative
-        Q[6, [2, 6]] = q_derivative
-        Q[7, [3, 7]] = q_derivative
-        kalman.processNoiseCov = Q
-
-        # R
-        R = measurement_variance * np.eye(4, dtype=np.float32)
-        kalman.measurementNoiseCov = R
-
-        self.kalman = kalman
+        # the measurement matrix H is [I, 0], so H @ x and H @ P are done by slicing
+        self.A, self.Q, self.R = _kalman_matrices(
+            process_variance, measurement_variance, dt
+        )
+        self.dt = np.float32(dt)
+        self.reset_state()
 
     def reset_state(self):
-        self.kalman.errorCovPost = np.zeros((8, 8), dtype=np.float32)
-        self.kalman.errorCovPre = np.zeros((8, 8), dtype=np.float32)
-        self.kalman.statePre = np.zeros((8, 1), dtype=np.float32)
-        self.kalman.statePost = np.zeros((8, 1), dtype=np.float32)
+        self._x = np.zeros((8,), dtype=np.float32)
+        self._P = np.zeros((8, 8), dtype=np.float32)
 
-    def predict(self, trajectory, future_len=1):
-        if isinstance(trajectory, torch.Tensor):
-            return_torch = True
-            trajectory = trajectory.numpy()
-        else:
-            return_torch = False
+    def _predict_step(self):
+        self._x = self.A @ self._x
+        self._P = self.A @ self._P @ self.A.T + self.Q
+        return self._x[:4]
 
-        self.smooth(trajectory)
-        pred = []
-        initial_pos = trajectory[0]
-        for _ in range(future_len):
-            next_pos = self.kalman.predict()[:4].squeeze() + initial_pos
-            pred.append(next_pos)
+    def _correct_step(self, measurement):
+        PHt = self._P[:, :4]
+        S = self._P[:4, :4] + self.R
+        K = np.linalg.solve(S, PHt.T).T
+        self._x = self._x + K @ (measurement - self._x[:4])
+        self._P = self._P - K @ self._P[:4]
 
-        pred = np.stack(pred, axis=0)
-        if return_torch:
-            pred = torch.from_numpy(pred)
-        return pred
+    def predict(self, trajectory, future_len=1):
+        if torch.is_tensor(trajectory):
+            return torch.from_numpy(
+                self._predict_np(trajectory.numpy(), future_len)
+            )
+        return self._predict_np(trajectory, future_len)
 
     def smooth(self, trajectory):
         """
@@ -234,25 +289,39 @@ class KalmanFilter:
         -------
         trajectory : [L, 4]
         """
-        if isinstance(trajectory, torch.Tensor):
-            return_torch = True
-            trajectory = trajectory.numpy()
-        else:
-            return_torch = False
+        if torch.is_tensor(trajectory):
+            return torch.from_numpy(self._smooth_np(trajectory.numpy()))
+        return self._smooth_np(trajectory)
+
+    def _predict_np(self, trajectory, future_len):
+        # goes through self.smooth, so that FullFilter can freeze standing objects
+        self.smooth(trajectory)
+        initial_pos = trajectory[0]
 
-        smoothed_trajectory = []
-        for position in trajectory:
-            predicted_position = (
-                self.kalman.predict()[:4].squeeze() + trajectory[0]
+        # without measurements x_k = A^k x, and A^k = [[I, k * dt * I], [0, I]]
+        step_times = np.arange(1, future_len + 1, dtype=np.float32) * self.dt
+        position, velocity = self._x[:4], self._x[4:]
+        pred = (
+            position + step_times[:, np.newaxis] * velocity + initial_pos
+        ).astype(np.result_type(trajectory, np.float32))
+        if future_len > 0:
+            self._x = np.concatenate(
+                [position + step_times[-1] * velocity, velocity]
             )
-            self.kalman.correct(position - trajectory[0])
-            smoothed_trajectory.append(predicted_position)
-        # smoothed_trajectory.pop(-1)
-        # smoothed_trajectory.append(trajectory[-1])
-
-        smoothed_trajectory = np.stack(smoothed_trajectory, axis=0)
-        if return_torch:
-            smoothed_trajectory = torch.from_numpy(smoothed_trajectory)
+        # keep the covariance consistent with the state, as _predict_step would
+        for _ in range(future_len):
+            self._P = self.A @ self._P @ self.A.T + self.Q
+        return pred
+
+    def _smooth_np(self, trajectory):
+        initial_pos = trajectory[0]
+        relative_trajectory = (trajectory - initial_pos).astype(np.float32)
+        smoothed_trajectory = np.empty(
+            trajectory.shape, dtype=np.result_type(trajectory, np.float32)
+        )
+        for step, position in enumerate(relative_trajectory):
+            smoothed_trajectory[step] = self._predict_step() + initial_pos
+            self._correct_step(position)
         return smoothed_trajectory
 
 
@@ -19,7 +19,10 @@ import src.market.metrics as metrics
 from src.utils.torch_utils import run_model_on_list
 from src.tracker.utils import prepare_crops_for_reid
 import torchvision
-from src.motion_prediction.kalman import SORTKalmanFilter, obj_is_moving
+from src.motion_prediction.kalman import (
+    BatchedSORTKalmanFilter,
+    obj_is_moving,
+)
 
 _UNMATCHED_COST = 255
 
@@ -88,19 +91,20 @@ class Track(object):
 
 
 class KalmanTrack(Track):
+    """Track whose kalman state is kept in the filter of its KalmanTracker."""
+
     def __init__(self, box, **kwargs):
         super().__init__(box=box, **kwargs)
-        self.kalman = SORTKalmanFilter()
-        self.kalman.update(box)
         self.preds = box.unsqueeze(0)
+        # box matched in this frame, not yet passed to the kalman filter
+        self.pending_box = None
 
     def get_result(self):
         box = self.preds[-1].cpu().numpy()
         score = np.array([self.score])
         return np.concatenate([box, score])
 
-    def step_kalman(self):
-        pred = self.kalman.predict()
+    def step_kalman(self, pred):
         self.preds = torch.cat([self.preds, pred.unsqueeze(0)], dim=0)
 
     def get_box(self):
@@ -108,7 +112,7 @@ class KalmanTrack(Track):
 
     def add_box(self, box):
         super().add_box(box)
-        self.kalman.update(box)
+        self.pending_box = box
 
 
 class DistractorAwareTrack(KalmanTrack):
@@ -538,14 +542,46 @@ class Tracker(TrackerBasis):
 class KalmanTracker(Tracker):
     def __init__(self, track_cls=KalmanTrack, **kwargs):
         super().__init__(track_cls=track_cls, **kwargs)
+        self.kalman = BatchedSORTKalmanFilter()
+
+    def reset(self):
+        super().reset()
+        self.kalman.reset()
 
     def _assert_kalman_steps(self):
         for t in self.tracks:
             len(t.boxes) == len(t.preds)
 
     def _step_kalman(self):
-        for t in self.tracks:
-            t.step_kalman()
+        """
+        One batched kalman step for all tracks
+        - drop the filters of removed tracks
+        - start the filters of tracks that were added in the last frame
+        - correct with the boxes that were matched in the last frame
+        - predict the boxes of the current frame
+        """
+        self.kalman.keep([t.id for t in self.tracks])
+
+        new_tracks = [t for t in self.tracks if t.id not in self.kalman]
+        if len(new_tracks) > 0:
+            self.kalman.add(
+                [t.id for t in new_tracks],
+                torch.stack([t.boxes[-1] for t in new_tracks], dim=0),
+            )
+
+        matched_tracks = [t for t in self.tracks if t.pending_box is not None]
+        if len(matched_tracks) > 0:
+            self.kalman.update(
+                [t.id for t in matched_tracks],
+                torch.stack([t.pending_box for t in matched_tracks], dim=0),
+            )
+            for t in matched_tracks:
+                t.pending_box = None
+
+        preds = self.kalman.predict()
+        track_by_id = {t.id: t for t in self.tracks}
+        for track_id, pred in zip(self.kalman.track_ids, preds):
+            track_by_id[track_id].step_kalman(pred)
 
     def _data_association(self, boxes, scores, reid_features, masks):
         self._step_kalman()
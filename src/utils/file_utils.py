@@ -8,4 +8,12 @@ def ensure_dir(file_path):
 def listdir_nohidden(path):
     for f in os.listdir(path):
         if not f.startswith("."):
-            yield f
\ No newline at end of file
+            yield f
+
+
+def scandir_nohidden(path):
+    """Sorted paths of the non-hidden entries of a directory, in a single scan."""
+    with os.scandir(path) as it:
+        return sorted(
+            entry.path for entry in it if not entry.name.startswith(".")
+        )